@@ -1,28 +1,127 @@
+import asyncio
+import functools
+import importlib.util
+import io
+import random
+import socket
+import time
+from contextlib import AbstractAsyncContextManager
 from types import TracebackType
-from typing import AsyncGenerator, Self
+from typing import TYPE_CHECKING, AsyncGenerator, Callable, ClassVar, Self
 
-import asyncio
 import aiohttp
 import msgspec
-from fake_useragent import UserAgent
+from multidict import CIMultiDict
 
 from .exceptions import (
     ConversationLimitException,
     DuckChatException,
     RatelimitException,
+    ServerBusyException,
 )
-from .models import History, ModelType
+from .models import ChatChunk, ErrorEnvelope, History, Message, ModelType, Role
+from .sse import iter_data
+
+if TYPE_CHECKING:
+    from fake_useragent import UserAgent
+
+# aiohttp only decodes brotli responses when one of these packages is installed
+HAS_BROTLI = any(importlib.util.find_spec(name) for name in ("brotli", "brotlicffi"))
+
+HEADERS = {
+    "Host": "duckduckgo.com",
+    "Accept": "text/event-stream",
+    "Accept-Language": "en-US,en;q=0.5",
+    "Accept-Encoding": "gzip, deflate, br" if HAS_BROTLI else "gzip, deflate",
+    "Referer": "https://duckduckgo.com/",
+    "x-vqd-4": "",
+    "DNT": "1",
+    "Sec-GPC": "1",
+    "Connection": "keep-alive",
+    "Sec-Fetch-Dest": "empty",
+    "Sec-Fetch-Mode": "cors",
+    "Sec-Fetch-Site": "same-origin",
+    "TE": "trailers",
+}
+
+# Data values that end the chat stream
+TERMINATORS = frozenset((b"[DONE]", b"[LIMIT_CONVERSATION]", b"[DONE][LIMIT_CONVERSATION]"))
+
+# Bodies above this size are sent in chunks (matches aiohttp's "large body" warning threshold)
+LARGE_BODY_SIZE = 2**20
+
+# No total limit so long answers can finish; hung connections are caught by connect/sock_read
+DEFAULT_TIMEOUT = aiohttp.ClientTimeout(total=None, connect=5, sock_read=30)
+
+# Adaptive token bucket for chat requests (rates are in requests per second)
+BUCKET_CAPACITY = 10.0
+INITIAL_RATE = 2.0
+MIN_RATE = 0.5
+MAX_RATE = 20.0
+RATE_STEP = 0.1  # additive increase on success
+RATE_ALPHA = 0.5  # extra increase while the rate is low
+RATE_BETA = 0.7  # multiplicative decrease on rate limit
+
+
+@functools.cache
+def _get_user_agent() -> "UserAgent":
+    """Get the shared UserAgent, importing fake_useragent (and loading its data) on first use."""
+    from fake_useragent import UserAgent
+
+    return UserAgent(min_version=120.0)
+
+
+class _RateBucket:
+    """Adaptive token bucket for chat requests, with additive increase and multiplicative decrease of its rate."""
+
+    def __init__(self) -> None:
+        self.tokens = BUCKET_CAPACITY
+        self.rate = INITIAL_RATE
+        self.last = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(BUCKET_CAPACITY, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    async def acquire(self) -> None:
+        """Take a token, waiting for a refill if the bucket is empty."""
+        while True:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def increase(self) -> None:
+        self.rate = min(MAX_RATE, self.rate + RATE_STEP + RATE_ALPHA / self.rate)
+
+    def decrease(self) -> None:
+        """Slow down after a rate limit, dropping the saved burst so the next request waits a full 1 / rate."""
+        self._refill()
+        self.rate = max(MIN_RATE, self.rate * RATE_BETA)
+        self.tokens = min(self.tokens, 0.0)
 
 
 class DuckChat:
+    # Keyed by ipv4_only; a connector is bound to the event loop it was created in
+    _shared_connectors: ClassVar[dict[bool, tuple[asyncio.AbstractEventLoop, aiohttp.TCPConnector]]] = {}
+    # Paces all instances with shared_connector=True together, so a rate limit slows every one of them
+    _shared_bucket: ClassVar[_RateBucket] = _RateBucket()
+
     def __init__(
         self,
         model: ModelType = ModelType.Claude,
         session: aiohttp.ClientSession | None = None,
-        user_agent: UserAgent | str = UserAgent(min_version=120.0),
+        user_agent: "UserAgent | str | None" = None,
         proxy: str | None = None,
-        max_retries: int = 3, 
-        delay: int = 10, 
+        max_retries: int = 3,
+        delay: int = 10,
+        max_delay: int = 30,
+        shared_connector: bool = False,
+        history_budget: int | None = None,
+        timeout: aiohttp.ClientTimeout | None = None,
+        ipv4_only: bool = False,
     ) -> None:
         """Initialize the DuckChat instance.
 
@@ -30,40 +129,67 @@ class DuckChat:
             model: The model type to use (default: ModelType.Claude).
             session: An optional aiohttp.ClientSession. If not provided, a new session is created.
             user_agent: A UserAgent object or string for the HTTP User-Agent header.
+                If not provided, a random one is picked from a shared UserAgent.
             proxy: An optional proxy URL (e.g., "http://proxy.example.com:8080") to use for requests.
             max_retries: Maximum number of retry attempts for rate limit errors (default: 3).
-            delay: Delay in seconds between retry attempts (default: 10).
+            delay: Base delay in seconds for the exponential backoff between retry attempts (default: 10).
+            max_delay: Upper bound in seconds for a single backoff delay, Retry-After included (default: 30).
+            shared_connector: Pool connections with other DuckChat instances through a
+                connector that stays open after this instance is closed, and pace their chat requests
+                with one shared rate limiter (default: False). Await DuckChat.close_shared_connector()
+                before the event loop ends, or aiohttp warns about an unclosed connector.
+            history_budget: If set, send only the latest messages of the history whose total length
+                fits into this number of characters. The full history is still kept locally (default: None).
+            timeout: Timeout applied to every request instead of the session's one (default: None, which keeps
+                the session's timeout; a session created by DuckChat gets DEFAULT_TIMEOUT, i.e. 5s to connect,
+                30s between reads and no total limit). Timed out attempts of get_answer are retried like rate
+                limit errors.
+            ipv4_only: Connect over IPv4 only, skipping the IPv6 lookup and connection race (default: False).
+                Applies to the session created by DuckChat.
         """
-        if isinstance(user_agent, str):
+        if user_agent is None:
+            self.user_agent = _get_user_agent().random
+        elif isinstance(user_agent, str):
             self.user_agent = user_agent
         else:
-            self.user_agent = user_agent.random  
-
-        self._session = session or aiohttp.ClientSession(
-            headers={
-                "Host": "duckduckgo.com",
-                "Accept": "text/event-stream",
-                "Accept-Language": "en-US,en;q=0.5",
-                "Accept-Encoding": "gzip, deflate, br",
-                "Referer": "https://duckduckgo.com/",
-                "User-Agent": self.user_agent,
-                "x-vqd-4": "",
-                "DNT": "1",
-                "Sec-GPC": "1",
-                "Connection": "keep-alive",
-                "Sec-Fetch-Dest": "empty",
-                "Sec-Fetch-Mode": "cors",
-                "Sec-Fetch-Site": "same-origin",
-                "TE": "trailers",
-            }
-        )
+            self.user_agent = user_agent.random
+
+        if session is None:
+            session = aiohttp.ClientSession(
+                headers={**HEADERS, "User-Agent": self.user_agent},
+                connector=(
+                    self.get_shared_connector(ipv4_only)
+                    if shared_connector
+                    else aiohttp.TCPConnector(family=socket.AF_INET if ipv4_only else socket.AF_UNSPEC)
+                ),
+                connector_owner=not shared_connector,
+                timeout=DEFAULT_TIMEOUT,
+            )
+        self._session = session
+        self._chat_url = "https://duckduckgo.com/duckchat/v1/chat"
+        self._status_url = "https://duckduckgo.com/duckchat/v1/status"
+        # Reused by every chat request; aiohttp copies it into the request before the first await,
+        # so setting x-vqd-4 right before posting is safe with concurrent requests
+        self._chat_headers = CIMultiDict({"Content-Type": "application/json", "x-vqd-4": ""})
+        # One token per turn: vqd[n] continues the dialog after n answers, reask_question resumes from it
         self.vqd: list[str] = []
+        # Held by get_answer, ask_question and reask_question until the answer is committed, so they run
+        # one after another. Streams hold it only while reading the token and history, never across a yield
+        self._turn_lock = asyncio.Lock()
+        # Bumped by every change of vqd and history; an answer is committed only if it has not moved since
+        self._generation = 0
         self.history = History(model, [])
-        self.__encoder = msgspec.json.Encoder()
-        self.__decoder = msgspec.json.Decoder()
+        self._encoder = msgspec.json.Encoder()
+        self._decoder = msgspec.json.Decoder(ChatChunk)
+        self._error_decoder = msgspec.json.Decoder(ErrorEnvelope)
         self.proxy = proxy
         self.max_retries = max_retries  # Store as class property
         self.delay = delay  # Store as class property
+        self.max_delay = max_delay
+        self.history_budget = history_budget
+        # The session's timeout unless one is given, so passing it with each request changes nothing
+        self.timeout = session.timeout if timeout is None else timeout
+        self._bucket = self._shared_bucket if shared_connector else _RateBucket()
 
     async def __aenter__(self) -> Self:
         return self
@@ -76,155 +202,268 @@ class DuckChat:
     ) -> None:
         await self._session.__aexit__(exc_type, exc_value, traceback)
 
+    @classmethod
+    def get_shared_connector(cls, ipv4_only: bool = False) -> aiohttp.TCPConnector:
+        """Get the connector pooled by DuckChat instances in the running event loop, creating it on first use."""
+        loop = asyncio.get_running_loop()
+        entry = cls._shared_connectors.get(ipv4_only)
+        if entry is None or entry[0] is not loop or entry[1].closed:
+            connector = aiohttp.TCPConnector(
+                family=socket.AF_INET if ipv4_only else socket.AF_UNSPEC,
+                limit=100,
+                limit_per_host=20,
+                keepalive_timeout=75,
+                ttl_dns_cache=300,
+            )
+            entry = cls._shared_connectors[ipv4_only] = (loop, connector)
+        return entry[1]
+
+    @classmethod
+    async def close_shared_connector(cls) -> None:
+        """Close the pooled connectors of the running event loop, e.g. before it is shut down."""
+        loop = asyncio.get_running_loop()
+        for ipv4_only, (connector_loop, connector) in list(cls._shared_connectors.items()):
+            if connector_loop is loop:
+                await connector.close()
+                del cls._shared_connectors[ipv4_only]
+
     async def get_answer(self) -> str:
-        """Get message answer from chatbot with retry logic for rate limits"""
+        """Get message answer from chatbot with retry logic for rate limits and timeouts"""
+        async with self._turn_lock:
+            generation = self._generation
+            message, vqd = await self._post_chat(self.vqd[-1], self._encode_history(self.history))
+            self._add_vqd(generation, vqd)
+            return message
+
+    async def _post_chat(self, vqd: str, body: bytes) -> tuple[str, str]:
+        """Get answer and next x-vqd-4 token for the encoded history, without changing the dialog."""
         attempt = 0  # Local variable for attempt counter
+        error = "ERR_BN_LIMIT"
         while attempt < self.max_retries:
-            async with self._session.post(
-                "https://duckduckgo.com/duckchat/v1/chat",
-                headers={
-                    "Content-Type": "application/json",
-                    "x-vqd-4": self.vqd[-1],
-                },
-                data=self.__encoder.encode(self.history),
-            ) as response:
-                res = await response.read()
-                if response.status == 429:
-                    raise RatelimitException(res.decode())
-                try:
-                    data = self.__decoder.decode(
-                        b"["
-                        + b",".join(
-                            res.lstrip(b"data: ").rstrip(b"\n\ndata: [DONE][LIMIT_CONVERSATION]\n").split(b"\n\ndata: ")
-                        )
-                        + b"]"
-                    )
-                except Exception:
-                    raise DuckChatException(f"Couldn't parse body={res.decode()}")
-                message = []
-                has_error = False
-                for x in data:
-                    if x.get("action") == "error":
-                        err_message = x.get("type", "") or str(x)
-                        if err_message == "ERR_BN_LIMIT":
-                            has_error = True
-                            break
-                        elif x.get("status") == 429:
-                            if err_message == "ERR_CONVERSATION_LIMIT":
-                                raise ConversationLimitException(err_message)
-                            raise RatelimitException(err_message)
-                        else:
-                            raise DuckChatException(err_message)
-                    message.append(x.get("message", ""))
-                if not has_error:
-                    self.vqd.append(response.headers.get("x-vqd-4", ""))
-                    return "".join(message)
-                attempt += 1
-                if attempt < self.max_retries:
-                    await asyncio.sleep(self.delay)
-        raise DuckChatException(f"ERR_BN_LIMIT after {self.max_retries} attempts")
+            await self._bucket.acquire()
+            try:
+                async with self._request_chat(vqd, body) as response:
+                    message = io.StringIO()
+                    try:
+                        async for data in self._iter_chunks(response):
+                            message.write(data.message)
+                    except ServerBusyException:
+                        error = "ERR_BN_LIMIT"
+                        retry_after = response.headers.get("Retry-After")
+                    else:
+                        self._bucket.increase()
+                        return message.getvalue(), response.headers.get("x-vqd-4", "")
+            except asyncio.TimeoutError:
+                error, retry_after = "Timeout", None
+            attempt += 1
+            if attempt < self.max_retries:
+                await asyncio.sleep(self._get_backoff(attempt, retry_after))
+        raise DuckChatException(f"{error} after {self.max_retries} attempts")
+
+    async def _iter_chunks(self, response: aiohttp.ClientResponse) -> AsyncGenerator[ChatChunk, None]:
+        """Decode chat chunks of the response one SSE frame at a time, raising on rate limits and error chunks."""
+        if response.status == 429:
+            self._bucket.decrease()
+            raise RatelimitException(await response.text())
+        decode = self._decoder.decode
+        async for chunk in iter_data(response.content):
+            if chunk in TERMINATORS:
+                break
+            try:
+                data = decode(chunk)
+            except msgspec.DecodeError:
+                raise DuckChatException(f"Couldn't parse body={bytes(chunk).decode()}")
+            if data.action == "error":
+                err_message = data.type or str(data)
+                if err_message == "ERR_BN_LIMIT":
+                    self._bucket.decrease()
+                    raise ServerBusyException(err_message)
+                elif data.status == 429:
+                    if err_message == "ERR_CONVERSATION_LIMIT":
+                        raise ConversationLimitException(err_message)
+                    self._bucket.decrease()
+                    raise RatelimitException(err_message)
+                else:
+                    raise DuckChatException(err_message)
+            yield data
+
+    def _encode_history(self, history: History) -> bytes:
+        """Encode the request body, trimming the history to history_budget if it is set."""
+        if self.history_budget is not None:
+            history = history.trimmed(self.history_budget)
+        return self._encoder.encode(history)
+
+    def _request_chat(self, vqd: str, body: bytes) -> AbstractAsyncContextManager[aiohttp.ClientResponse]:
+        """Prepare a chat request, to be entered right away with async with."""
+        self._chat_headers["x-vqd-4"] = vqd
+        return self._session.post(
+            self._chat_url,
+            headers=self._chat_headers,
+            data=self._as_payload(body),
+            proxy=self.proxy,
+            timeout=self.timeout,
+        )
+
+    @staticmethod
+    def _as_payload(body: bytes) -> bytes | aiohttp.BytesIOPayload:
+        """Wrap a large body so aiohttp writes it in chunks instead of blocking the event loop."""
+        if len(body) > LARGE_BODY_SIZE:
+            return aiohttp.BytesIOPayload(io.BytesIO(body), content_type="application/json")
+        return body
+
+    def _get_backoff(self, attempt: int, retry_after: str | None = None) -> float:
+        """Get delay before the next attempt: Retry-After if given, else exponential backoff with full jitter.
+
+        Either way the delay is capped at max_delay.
+        """
+        if retry_after:
+            try:
+                return min(float(self.max_delay), max(0.0, float(retry_after)))
+            except ValueError:
+                pass
+        return random.random() * min(self.max_delay, self.delay * 2.0 ** (attempt - 1))
 
     async def get_vqd(self) -> None:
         """Get new x-vqd-4 token."""
+        async with self._turn_lock:
+            generation = self._generation
+            self._add_vqd(generation, await self._fetch_vqd())
+
+    async def _fetch_vqd(self) -> str:
+        """Fetch a token that starts a new dialog."""
         async with self._session.get(
-            "https://duckduckgo.com/duckchat/v1/status",
+            self._status_url,
             headers={"x-vqd-accept": "1"},
             proxy=self.proxy,
+            timeout=self.timeout,
         ) as response:
             if response.status == 429:
                 res = await response.read()
                 try:
-                    err_message = self.__decoder.decode(res).get("type", "")
+                    err_message = self._error_decoder.decode(res).type
                 except Exception:
                     raise DuckChatException(res.decode())
                 else:
                     raise RatelimitException(err_message)
             if "x-vqd-4" in response.headers:
-                self.vqd.append(response.headers["x-vqd-4"])
-            else:
-                raise DuckChatException("No x-vqd-4")
+                return response.headers["x-vqd-4"]
+            raise DuckChatException("No x-vqd-4")
 
     async def stream_answer(self) -> AsyncGenerator[str, None]:
         """Stream answer from chatbot."""
-        async with self._session.post(
-            "https://duckduckgo.com/duckchat/v1/chat",
-            headers={
-                "Content-Type": "application/json",
-                "x-vqd-4": self.vqd[-1],
-            },
-            data=self.__encoder.encode(self.history),
-            proxy=self.proxy,
-        ) as response:
-            if response.status == 429:
-                raise RatelimitException(await response.text())
-            try:
-                async for line in response.content:
-                    if line.startswith(b"data: "):
-                        chunk = line[6:]
-                        if chunk.startswith(b"[DONE]"):
-                            break
-                        try:
-                            data = self.__decoder.decode(chunk)
-                            if "message" in data and data["message"]:
-                                yield data["message"]
-                        except Exception:
-                            raise DuckChatException(f"Couldn't parse body={chunk.decode()}")
-            except Exception as e:
-                raise DuckChatException(f"Error while streaming data: {str(e)}")
-        self.vqd.append(response.headers.get("x-vqd-4", ""))
+        async with self._turn_lock:
+            generation, vqd, body = self._generation, self.vqd[-1], self._encode_history(self.history)
+        async for message in self._stream_chat(vqd, body, lambda _, next_vqd: self._add_vqd(generation, next_vqd)):
+            yield message
+
+    async def _stream_chat(
+        self, vqd: str, body: bytes, on_done: Callable[[str, str], None]
+    ) -> AsyncGenerator[str, None]:
+        """Stream answer for the encoded history, passing the full answer and next token to on_done at the end."""
+        await self._bucket.acquire()
+        buf = io.StringIO()
+        try:
+            async with self._request_chat(vqd, body) as response:
+                try:
+                    async for data in self._iter_chunks(response):
+                        if data.message:
+                            buf.write(data.message)
+                            yield data.message
+                except (DuckChatException, asyncio.TimeoutError):
+                    raise
+                except Exception as e:
+                    raise DuckChatException(f"Error while streaming data: {str(e)}")
+        except asyncio.TimeoutError:
+            raise DuckChatException(
+                f"Timeout while streaming data (connect={self.timeout.connect}s, sock_read={self.timeout.sock_read}s)"
+            )
+        self._bucket.increase()
+        on_done(buf.getvalue(), response.headers.get("x-vqd-4", ""))
 
     async def ask_question(self, query: str) -> str:
         """Get answer from chat AI."""
-        if not self.vqd:
-            await self.get_vqd()
-        self.history.add_input(query)
-        message = await self.get_answer()
-        self.history.add_answer(message)
-        return message
+        async with self._turn_lock:
+            await self._ensure_vqd()
+            generation = self._generation
+            history = History(self.history.model, [*self.history.messages, Message(Role.user, query)])
+            message, vqd = await self._post_chat(self.vqd[-1], self._encode_history(history))
+            self._add_turn(generation, query, message, vqd)
+            return message
 
     async def reask_question(self, num: int) -> str:
         """Get re-answer from chat AI."""
-        if num >= len(self.vqd):
-            num = len(self.vqd) - 1
-        self.vqd = self.vqd[:num]
-        if not self.history.messages:
-            return ""
-        if not self.vqd:
-            await self.get_vqd()
-            self.history.messages = [self.history.messages[0]]
-        else:
-            num = min(num, len(self.vqd))
-            self.history.messages = self.history.messages[: (num * 2 - 1)]
-        message = await self.get_answer()
-        self.history.add_answer(message)
-        return message
+        async with self._turn_lock:
+            generation = self._generation
+            rewound = await self._rewind(num)
+            if rewound is None:
+                return ""
+            vqd, messages = rewound
+            body = self._encode_history(History(self.history.model, messages))
+            message, next_vqd = await self._post_chat(vqd[-1], body)
+            self._set_dialog(generation, vqd, messages, message, next_vqd)
+            return message
 
     async def ask_question_stream(self, query: str) -> AsyncGenerator[str, None]:
         """Stream answer from chat AI."""
-        if not self.vqd:
-            await self.get_vqd()
-        self.history.add_input(query)
-        message_list = []
-        async for message in self.stream_answer():
+        async with self._turn_lock:
+            await self._ensure_vqd()
+            generation, vqd = self._generation, self.vqd[-1]
+            history = History(self.history.model, [*self.history.messages, Message(Role.user, query)])
+            body = self._encode_history(history)
+        async for message in self._stream_chat(
+            vqd, body, lambda answer, next_vqd: self._add_turn(generation, query, answer, next_vqd)
+        ):
             yield message
-            message_list.append(message)
-        self.history.add_answer("".join(message_list))
 
     async def reask_question_stream(self, num: int) -> AsyncGenerator[str, None]:
         """Stream re-answer from chat AI."""
+        async with self._turn_lock:
+            generation = self._generation
+            rewound = await self._rewind(num)
+            if rewound is None:
+                raise GeneratorExit("There is no history messages")
+            vqd, messages = rewound
+            body = self._encode_history(History(self.history.model, messages))
+        async for message in self._stream_chat(
+            vqd[-1], body, lambda answer, next_vqd: self._set_dialog(generation, vqd, messages, answer, next_vqd)
+        ):
+            yield message
+
+    async def _rewind(self, num: int) -> tuple[list[str], list[Message]] | None:
+        """Get tokens and history messages to re-ask question num with, or None if there is no history."""
         if num >= len(self.vqd):
             num = len(self.vqd) - 1
-        self.vqd = self.vqd[:num]
+        vqd = self.vqd[:num]
         if not self.history.messages:
-            raise GeneratorExit("There is no history messages")
+            return None
+        if not vqd:
+            return [await self._fetch_vqd()], self.history.messages[:1]
+        num = min(num, len(vqd))
+        return vqd, self.history.messages[: (num * 2 - 1)]
+
+    async def _ensure_vqd(self) -> None:
+        """Fetch the token of a new dialog if there is none yet."""
         if not self.vqd:
-            await self.get_vqd()
-            self.history.messages = [self.history.messages[0]]
-        else:
-            num = min(num, len(self.vqd))
-            self.history.messages = self.history.messages[: (num * 2 - 1)]
-        message_list = []
-        async for message in self.stream_answer():
-            yield message
-            message_list.append(message)
-        self.history.add_answer("".join(message_list))
\ No newline at end of file
+            generation = self._generation
+            self._add_vqd(generation, await self._fetch_vqd())
+
+    def _commit(self, generation: int) -> None:
+        """Start a change of the dialog read at generation, refusing it if the dialog has changed since."""
+        if generation != self._generation:
+            raise DuckChatException("Dialog changed while waiting for the answer")
+        self._generation += 1
+
+    def _add_vqd(self, generation: int, vqd: str) -> None:
+        self._commit(generation)
+        self.vqd.append(vqd)
+
+    def _add_turn(self, generation: int, query: str, answer: str, vqd: str) -> None:
+        self._commit(generation)
+        self.history.add_input(query)
+        self.history.add_answer(answer)
+        self.vqd.append(vqd)
+
+    def _set_dialog(self, generation: int, vqd: list[str], messages: list[Message], answer: str, next_vqd: str) -> None:
+        self._commit(generation)
+        self.vqd = [*vqd, next_vqd]
+        self.history.messages = [*messages, Message(Role.assistant, answer)]
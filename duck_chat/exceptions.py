@@ -11,3 +11,7 @@ class RatelimitException(DuckChatException):
 
 class ConversationLimitException(DuckChatException):
     """Raised for conversation limit during API requests to AI endpoint."""
+
+
+class ServerBusyException(RatelimitException):
+    """Raised for ERR_BN_LIMIT errors, the AI endpoint is temporarily busy and the request may be retried."""
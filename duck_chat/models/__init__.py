@@ -1,4 +1,4 @@
 from .model_type import ModelType
-from .models import History, Message, Role
+from .models import ChatChunk, ErrorEnvelope, History, Message, Role
 
-__all__ = ["History", "ModelType", "Message", "Role"]
+__all__ = ["ChatChunk", "ErrorEnvelope", "History", "ModelType", "Message", "Role"]
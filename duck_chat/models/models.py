@@ -24,3 +24,29 @@ class History(msgspec.Struct):
 
     def add_answer(self, message: str) -> None:
         self.messages.append(Message(Role.assistant, message))
+
+    def trimmed(self, budget_chars: int) -> "History":
+        """Get a copy with the latest messages whose content fits into budget_chars.
+
+        The latest message is always kept and the window starts on a user message.
+        """
+        start, size = len(self.messages), 0
+        while start > 0:
+            size += len(self.messages[start - 1].content)
+            if size > budget_chars and start < len(self.messages):
+                break
+            start -= 1
+        while start < len(self.messages) - 1 and self.messages[start].role is not Role.user:
+            start += 1
+        return History(self.model, self.messages[start:])
+
+
+class ChatChunk(msgspec.Struct):
+    message: str = ""
+    action: str = ""
+    type: str = ""
+    status: int = 0
+
+
+class ErrorEnvelope(msgspec.Struct):
+    type: str = ""
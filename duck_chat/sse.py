@@ -0,0 +1,46 @@
+from typing import AsyncGenerator
+
+import aiohttp
+
+DATA_PREFIX = b"data: "
+
+
+def _data_value(buffer: bytes, view: memoryview, start: int, end: int) -> memoryview | None:
+    """Get the value of the line buffer[start:end] if it is a data field."""
+    if end > start and buffer[end - 1] == 13:  # CR of a CRLF line ending
+        end -= 1
+    if buffer.startswith(DATA_PREFIX, start, end):
+        return view[start + len(DATA_PREFIX) : end]
+    return None
+
+
+async def iter_data(content: aiohttp.StreamReader) -> AsyncGenerator[memoryview, None]:
+    """Yield data field values of a server-sent events stream as soon as their line is complete.
+
+    Each received chunk is scanned once for line ends with bytes.find. Values are views into
+    the chunk they arrived in; only a line split across chunks is joined into a new bytes object.
+    """
+    pending: list[bytes] = []  # start of a line whose end has not arrived yet
+    async for chunk in content.iter_any():
+        start, end = 0, chunk.find(b"\n")
+        if end == -1:
+            pending.append(chunk)
+            continue
+        if pending:
+            pending.append(chunk[:end])
+            line = b"".join(pending)
+            pending.clear()
+            if (value := _data_value(line, memoryview(line), 0, len(line))) is not None:
+                yield value
+            start, end = end + 1, chunk.find(b"\n", end + 1)
+        view = memoryview(chunk)
+        while end != -1:
+            if (value := _data_value(chunk, view, start, end)) is not None:
+                yield value
+            start, end = end + 1, chunk.find(b"\n", end + 1)
+        if start < len(chunk):
+            pending.append(chunk[start:])
+    if pending:
+        line = b"".join(pending)
+        if (value := _data_value(line, memoryview(line), 0, len(line))) is not None:
+            yield value
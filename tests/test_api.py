@@ -1,9 +1,70 @@
 import asyncio
+import contextlib
+import json
 import random
+import time
+from typing import AsyncIterator
 
+import aiohttp
 import pytest
+from aiohttp import web
 
 from duck_chat import DuckChat, ModelType
+from duck_chat.api import INITIAL_RATE
+from duck_chat.exceptions import DuckChatException, ServerBusyException
+
+BN_LIMIT = [b'data: {"action": "error", "type": "ERR_BN_LIMIT", "status": 418}\r\n\r\n']
+SLOW = None  # answer after the client's sock_read timeout
+
+
+def answer_frames(text: str) -> list[bytes]:
+    frames = [f"data: {json.dumps({'message': word, 'action': 'success'})}\r\n\r\n".encode() for word in text]
+    return [*frames, b"data: [DONE]\r\n\r\n"]
+
+
+class FakeDuckChat:
+    """Local stand-in for the status and chat endpoints, recording the chat requests it gets."""
+
+    def __init__(self) -> None:
+        self.requests: list[tuple[str, dict]] = []
+        self.replies: list[list[bytes] | None] = []  # next replies, then answer_frames("ok")
+
+    async def status(self, request: web.Request) -> web.Response:
+        return web.Response(headers={"x-vqd-4": "vqd-0"})
+
+    async def chat(self, request: web.Request) -> web.StreamResponse:
+        self.requests.append((request.headers["x-vqd-4"], await request.json()))
+        frames = self.replies.pop(0) if self.replies else answer_frames("ok")
+        if frames is SLOW:
+            await asyncio.sleep(1)
+            frames = answer_frames("late")
+        response = web.StreamResponse(headers={"x-vqd-4": f"vqd-{len(self.requests)}"})
+        await response.prepare(request)
+        for frame in frames:
+            await response.write(frame)
+        return response
+
+
+@contextlib.asynccontextmanager
+async def serve(fake: FakeDuckChat) -> AsyncIterator[str]:
+    app = web.Application()
+    app.router.add_get("/duckchat/v1/status", fake.status)
+    app.router.add_post("/duckchat/v1/chat", fake.chat)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    try:
+        yield f"http://127.0.0.1:{runner.addresses[0][1]}"
+    finally:
+        await runner.cleanup()
+
+
+def local_chat(url: str, **kwargs) -> DuckChat:
+    chat = DuckChat(user_agent="test", delay=0, **kwargs)
+    chat._status_url = f"{url}/duckchat/v1/status"
+    chat._chat_url = f"{url}/duckchat/v1/chat"
+    return chat
 
 
 @pytest.fixture
@@ -45,3 +106,148 @@ async def test_steam_dialog(model, random_math_question):
         result3 = "".join([message async for message in chat.reask_question_stream(1)])
         assert answer in result3
         await asyncio.sleep(1)
+
+
+@pytest.mark.asyncio
+async def test_offline_dialog():
+    fake = FakeDuckChat()
+    async with serve(fake) as url, local_chat(url) as chat:
+        fake.replies = [answer_frames("four"), answer_frames("yes")]
+        assert await chat.ask_question("2 + 2?") == "four"
+        assert await chat.ask_question("Are you right?") == "yes"
+        assert await chat.reask_question(1) == "ok"
+
+    assert [(vqd, len(body["messages"])) for vqd, body in fake.requests] == [("vqd-0", 1), ("vqd-1", 3), ("vqd-0", 1)]
+    assert chat.vqd == ["vqd-0", "vqd-3"]
+    assert [message.content for message in chat.history.messages] == ["2 + 2?", "ok"]
+
+
+@pytest.mark.asyncio
+async def test_offline_retries_busy_server():
+    fake = FakeDuckChat()
+    async with serve(fake) as url, local_chat(url) as chat:
+        fake.replies = [BN_LIMIT]
+        assert await chat.ask_question("Hi") == "ok"
+        assert len(fake.requests) == 2
+        assert chat._bucket.rate < INITIAL_RATE
+
+        fake.replies = [BN_LIMIT] * chat.max_retries
+        with pytest.raises(DuckChatException, match="ERR_BN_LIMIT after 3 attempts"):
+            await chat.ask_question("Again")
+
+    assert len(fake.requests) == 2 + chat.max_retries
+    assert chat.vqd == ["vqd-0", "vqd-2"]
+    assert [message.content for message in chat.history.messages] == ["Hi", "ok"]
+
+
+@pytest.mark.asyncio
+async def test_offline_retries_timeout():
+    fake = FakeDuckChat()
+    async with serve(fake) as url, local_chat(url, timeout=aiohttp.ClientTimeout(sock_read=0.2)) as chat:
+        assert await chat.ask_question("Hi") == "ok"
+        fake.replies = [SLOW] * chat.max_retries
+        with pytest.raises(DuckChatException, match="Timeout after 3 attempts"):
+            await chat.ask_question("Again")
+
+    assert len(fake.requests) == 1 + chat.max_retries
+    assert chat.vqd == ["vqd-0", "vqd-1"]
+    assert [message.content for message in chat.history.messages] == ["Hi", "ok"]
+
+
+@pytest.mark.asyncio
+async def test_offline_session_timeout():
+    fake = FakeDuckChat()
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=0.3)) as session:
+        async with serve(fake) as url, local_chat(url, session=session, max_retries=1) as chat:
+            fake.replies = [SLOW]
+            with pytest.raises(DuckChatException, match="Timeout after 1 attempts"):
+                await chat.ask_question("Hi")
+
+
+@pytest.mark.asyncio
+async def test_offline_stream_error_chunk():
+    fake = FakeDuckChat()
+    async with serve(fake) as url, local_chat(url) as chat:
+        fake.replies = [[*answer_frames("ab")[:1], *BN_LIMIT]]
+        received = []
+        with pytest.raises(ServerBusyException):
+            async for message in chat.ask_question_stream("Hi"):
+                received.append(message)
+
+    assert received == ["a"]
+    assert chat._bucket.rate < INITIAL_RATE
+    assert chat.vqd == ["vqd-0"]
+    assert chat.history.messages == []
+
+
+@pytest.mark.asyncio
+async def test_offline_half_read_stream():
+    fake = FakeDuckChat()
+    async with serve(fake) as url, local_chat(url) as chat:
+        fake.replies = [answer_frames("ab")]
+        stream = chat.ask_question_stream("Hi")
+        assert await stream.__anext__() == "a"
+        assert await asyncio.wait_for(chat.ask_question("Again"), 1) == "ok"
+        with pytest.raises(DuckChatException, match="Dialog changed"):
+            async for _ in stream:
+                pass
+
+    assert [vqd for vqd, _ in fake.requests] == ["vqd-0", "vqd-0"]
+    assert chat.vqd == ["vqd-0", "vqd-2"]
+    assert [message.content for message in chat.history.messages] == ["Again", "ok"]
+
+
+@pytest.mark.asyncio
+async def test_offline_proxy():
+    fake = FakeDuckChat()
+    async with serve(fake) as url, local_chat("http://duckchat.invalid", proxy=url) as chat:
+        assert await chat.ask_question("Hi") == "ok"
+    assert fake.requests[0][0] == "vqd-0"
+
+
+@pytest.mark.asyncio
+async def test_backoff_is_capped():
+    async with DuckChat(user_agent="test", delay=10, max_delay=30) as chat:
+        assert chat._get_backoff(1, "3600") == 30
+        assert chat._get_backoff(1, "-5") == 0
+        assert all(0 <= chat._get_backoff(attempt) <= 30 for attempt in range(1, 10))
+
+
+@pytest.mark.asyncio
+async def test_bucket_waits_after_rate_limit():
+    async with DuckChat(user_agent="test") as chat:
+        bucket = chat._bucket
+        await bucket.acquire()
+        bucket.decrease()
+        start = time.monotonic()
+        await bucket.acquire()
+        assert time.monotonic() - start >= 0.9 / bucket.rate
+
+
+@pytest.mark.asyncio
+async def test_bucket_is_shared_with_shared_connector():
+    async with DuckChat(user_agent="test", shared_connector=True) as first:
+        async with DuckChat(user_agent="test", shared_connector=True) as second:
+            assert first._bucket is second._bucket
+        async with DuckChat(user_agent="test") as own:
+            assert own._bucket is not first._bucket
+    await DuckChat.close_shared_connector()
+
+
+@pytest.mark.filterwarnings("ignore:Unclosed connector:ResourceWarning")
+def test_shared_connector_across_event_loops():
+    fake = FakeDuckChat()
+    connectors = []
+
+    async def ask(close: bool) -> str:
+        async with serve(fake) as url, local_chat(url, shared_connector=True) as chat:
+            connectors.append(DuckChat.get_shared_connector())
+            answer = await chat.ask_question("Hi")
+        if close:
+            await DuckChat.close_shared_connector()
+        return answer
+
+    # The first loop ends with its connector still open, the second one must not reuse it
+    assert asyncio.run(ask(close=False)) == "ok"
+    assert asyncio.run(ask(close=True)) == "ok"
+    assert connectors[0] is not connectors[1]
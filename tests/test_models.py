@@ -0,0 +1,31 @@
+from duck_chat import ModelType
+from duck_chat.models import History, Role
+
+
+def make_history(*contents: str) -> History:
+    history = History(ModelType.Claude, [])
+    for i, content in enumerate(contents):
+        if i % 2:
+            history.add_answer(content)
+        else:
+            history.add_input(content)
+    return history
+
+
+def test_trimmed_keeps_history_within_budget():
+    history = make_history("a" * 10, "b" * 10, "c" * 10)
+    assert history.trimmed(100).messages == history.messages
+    assert [m.content for m in history.trimmed(15).messages] == ["c" * 10]
+    assert len(history.messages) == 3
+
+
+def test_trimmed_starts_on_user_message():
+    history = make_history("a" * 10, "b" * 10, "c" * 10, "d" * 10, "e" * 10)
+    messages = history.trimmed(40).messages
+    assert messages[0].role is Role.user
+    assert [m.content for m in messages] == ["c" * 10, "d" * 10, "e" * 10]
+
+
+def test_trimmed_keeps_latest_message():
+    history = make_history("a" * 10, "b" * 10, "c" * 100)
+    assert [m.content for m in history.trimmed(10).messages] == ["c" * 100]
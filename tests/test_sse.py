@@ -0,0 +1,45 @@
+import pytest
+
+from duck_chat.sse import iter_data
+
+
+class FakeContent:
+    def __init__(self, *chunks: bytes) -> None:
+        self.chunks = chunks
+        self.sent = 0
+
+    async def iter_any(self):
+        for chunk in self.chunks:
+            self.sent += 1
+            yield chunk
+
+
+async def collect(*chunks: bytes) -> list[bytes]:
+    return [bytes(value) async for value in iter_data(FakeContent(*chunks))]
+
+
+@pytest.mark.asyncio
+async def test_iter_data_splits_events():
+    result = await collect(b'data: {"message":"a"}\n\ndata: {"message":"b"}\n\ndata: [DONE]\n\n')
+    assert result == [b'{"message":"a"}', b'{"message":"b"}', b"[DONE]"]
+
+
+@pytest.mark.asyncio
+async def test_iter_data_joins_events_across_chunks():
+    result = await collect(b'data: {"mess', b'age":"a"}\n', b"\ndata: [DONE]\n")
+    assert result == [b'{"message":"a"}', b"[DONE]"]
+
+
+@pytest.mark.asyncio
+async def test_iter_data_skips_other_fields():
+    result = await collect(b"event: message\ndata: 1\n\n: comment\n\ndata: 2")
+    assert result == [b"1", b"2"]
+
+
+@pytest.mark.asyncio
+async def test_iter_data_streams_crlf_events():
+    content = FakeContent(b"data: 1\r", b"\n\r\nda", b"ta: 2\r\n", b"\r\n", b"")
+    received = []
+    async for value in iter_data(content):
+        received.append((bytes(value), content.sent))
+    assert received == [(b"1", 2), (b"2", 3)]